@@ -1,25 +1,58 @@
 #!/usr/bin/python3
 
-from subprocess import run
-from argparse import ArgumentParser
-from sys import argv, stderr
+from subprocess import run, Popen, PIPE
+from argparse import ArgumentParser, ArgumentTypeError, REMAINDER
+from sys import argv, stdout, stderr
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from decimal import Decimal
+from shutil import which
+import os
+import signal
+
+# External programs, looked up once. If one isn't found, the bare name is
+# used, so running it fails the same way it always has.
+_FFMPEG = which( 'ffmpeg' ) or 'ffmpeg'
+_FDKAAC = which( 'fdkaac' ) or 'fdkaac'
+_SOX = which( 'sox' ) or 'sox'
+
+# Signals Python ignores at startup. External programs need them back at
+# their defaults, as `subprocess` does with `restore_signals`.
+_RESTORE_SIGNALS = tuple( getattr( signal, name )
+                          for name in ('SIGPIPE', 'SIGXFSZ')
+                          if hasattr( signal, name ) )
+
+# Options shared by every command that writes files
+_FORCE = ArgumentParser( add_help=False )
+_FORCE.add_argument( '-f', '--force', action='store_true',
+                    help="Overwrite existing files" )
 
 class vtCommand:
     """Base class for all vidtool commands"""
 
     commands = {}
+    parsers = {}
+    jobs = None
 
-    def __init__( self, name, blurb=None ):
+    # The name of the command
+    name = None
+
+    # If true, `runFinal` replaces the Python process with the external
+    # program. Commands with work to do afterwards must leave this false.
+    execOk = False
+
+    # Arguments accepted by the command, as a list of tuples. Each tuple is
+    # the names or flags of one argument, followed by a dict of keyword
+    # arguments for `ArgumentParser.add_argument`.
+    arguments = []
+
+    # Parsers whose arguments are shared with the command's own
+    parents = [_FORCE]
+
+    def __init__( self, blurb=None ):
         """Initialize the command.
 
-        name -- The name of the command
         blurb -- A short description of the command. If none is provided,
           it is taken from the classes docstring.
         """
-        self.name = name
         if blurb:
             self.blurb = blurb
         else:
@@ -29,11 +62,99 @@ class vtCommand:
         """Execute the given command.
 
         argsin -- A list of arguments to the function
+
+        By default, this parses the arguments and runs the command line given
+        by `build`. Commands that do more than run a single program override
+        this instead.
+
+        Return: Numeric exit code from the command
+        """
+        parser = self.buildParser()
+        args = parser.parse_args( argsin )
+        self.validate( parser, args )
+        self.checkOutputs( args )
+        return self.runFinal( self.build( args ) )
+
+    def validate( self, parser, args ):
+        """Check parsed arguments for problems the parser can't catch.
+
+        parser -- The command's parser, used to report errors
+        args -- The parsed arguments to the command
+
+        Called before `build`, both when the command is run on its own and
+        in a pipeline. Errors are reported with `parser.error`, which exits.
         """
         pass
 
+    def outputs( self, args ):
+        """Get the files written by the command's program.
+
+        args -- The parsed arguments to the command
+
+        Only files the program can't be told how to handle if they already
+        exist are needed; see `checkExists`.
+
+        Return: A list of paths
+        """
+        return []
+
+    def checkOutputs( self, args ):
+        """Check each file from `outputs` with `checkExists`.
+
+        args -- The parsed arguments to the command. With -f, existing
+            files are deleted.
+        """
+        for path in self.outputs( args ):
+            checkExists( path, args.force )
+
+    # Commands which run a single program define `build( self, args )`,
+    # taking the parsed arguments and returning the command line to run, as
+    # a list. Those that leave it as None can't be used by the default `do`,
+    # or in a pipeline.
+    build = None
+
+    def buildParser( self ):
+        """Build the argument parser for the command.
+
+        The parser is built from the `arguments` of the class, and is only
+        built once per command; later calls return the same parser.
+        """
+
+        if self.name not in vtCommand.parsers:
+            parser = ArgumentParser( prog=self.name, description=self.blurb,
+                                    parents=self.parents )
+            for *names, options in self.arguments:
+                parser.add_argument( *names, **options )
+            vtCommand.parsers[self.name] = parser
+        return vtCommand.parsers[self.name]
+
+    def runFinal( self, cmd ):
+        """Run the last external program of the command.
+
+        cmd -- The command line to run, as a list
+
+        If `execOk` is set, the Python process is replaced by the program,
+        and this does not return; the program's exit code goes straight to
+        the caller. Otherwise, the program is run normally.
+
+        Return: Numeric exit code from the program
+        """
+
+        if self.execOk:
+            stdout.flush()
+            stderr.flush()
+            for sig in _RESTORE_SIGNALS:
+                signal.signal( sig, signal.SIG_DFL )
+            os.execvp( cmd[0], [str( arg ) for arg in cmd] )
+        return runCmd( cmd )
+
+    @classmethod
     def register( self ):
-        """Register the command in the list of commands."""
+        """Register the command in the list of commands.
+
+        Only the class is registered; it is instantiated when the command is
+        actually run.
+        """
         vtCommand.commands[self.name] = self
 
     def help( self ):
@@ -44,416 +165,716 @@ class vtCommand:
 class vtHelp( vtCommand ):
     """Get help for a command, or a list of commands"""
 
-    def __init__( self ):
-        super().__init__( 'help' )
-
-    def do( self, argsin ):
-        parser = ArgumentParser( prog=self.name, description=self.blurb )
+    name = 'help'
+    parents = []
 
-        parser.add_argument( 'command', nargs='?',
-                            help='Command to get help on' )
+    arguments = [
+        ('command', dict( nargs='?', help='Command to get help on' )),
+    ]
 
+    def do( self, argsin ):
+        parser = self.buildParser()
         args = parser.parse_args( argsin )
 
         if not args.command:
             print( "Available commands:" )
             for cmd in vtCommand.commands.values():
-                print( "%-10s %s" % (cmd.name, cmd.blurb) )
+                print( "%-10s %s" % (cmd.name, cmd.__doc__) )
         elif args.command in vtCommand.commands:
-            vtCommand.commands[args.command].help()
+            vtCommand.commands[args.command]().help()
         else:
             print( f"Invalid command: {args.command}" , file=stderr )
             exit( 1 )
-vtHelp().register()
+vtHelp.register()
 
 class vtMixdown( vtCommand ):
     """Mix multiple audio files into a single file"""
 
-    def __init__( self ):
-        super().__init__( 'mixdown' )
+    name = 'mixdown'
 
-    def do( self, argsin ):
-        parser = ArgumentParser( prog=self.name, description=self.blurb )
+    arguments = [
+        ('input', dict( nargs='+', help='Input files to mix' )),
+        ('output', dict( help='File to save to' )),
+    ]
 
-        parser.add_argument( 'input', nargs='+',
-                            help='Input files to mix' )
-        parser.add_argument( 'output',
-                            help='File to save to' )
-        parser.add_argument( '-f', '--force', action='store_true',
-                            help="Overwrite existing files" )
+    def build( self, args ):
+        return self.command( args.input, args.output, args.force )
 
-        args = parser.parse_args( argsin )
+    @classmethod
+    def execute( self, inputs, output, wait=True, force=False, **kwargs ):
+        """Execute ffmpeg to downmix the files
 
-        outpath = Path( args.output )
-        checkExists( outpath, args.force )
+        wait -- If false, start ffmpeg and return without waiting for it
+        force -- Overwrite the output file if it exists
+        kwargs -- Passed on to `runCmd`
 
-        self.execute( args.input, args.output )
+        Return: Numeric exit code from ffmpeg, or the running process if
+            wait is false
+        """
+
+        return runCmd( self.command( inputs, output, force ), wait, **kwargs )
 
     @classmethod
-    def execute( self, inputs, output ):
-        """Execute ffmpeg to downmix the files
+    def command( self, inputs, output, force=False ):
+        """Build the ffmpeg command to downmix the files.
 
-        Return: Numeric exit code from ffmpeg
+        output -- The file to save to. If '-', a WAV stream is written to
+            standard output.
+        force -- Overwrite the output file if it exists
+
+        Return: The command line, as a list
         """
 
-        cmd = ['ffmpeg']
+        cmd = [_FFMPEG, overwriteFlag( force )]
         for f in inputs:
             cmd.append( '-i' )
             cmd.append( f )
         cmd.append( '-filter_complex' )
         cmd.append( f'amix=inputs={len( inputs ) }:duration=first' )
+        if output == '-':
+            cmd.extend( ('-f', 'wav') )
         cmd.append( output )
-        result = run( cmd )
-        return result.returncode
-vtMixdown().register()
+        return cmd
+vtMixdown.register()
 
 class vtAACEnc( vtCommand ):
     """Encode an audio file to AAC"""
 
-    def __init__( self ):
-        super().__init__( 'aacenc' ) 
+    name = 'aacenc'
+
+    arguments = [
+        ('files', dict( nargs='+', metavar='FILE',
+                        help='Input file, and optionally output file. ' +
+                        'With -b, any number of input files.' )),
+        ('-b', '--batch', dict( action='store_true',
+                                help="Encode each input file to an " +
+                                'automatically named output file, ' +
+                                'several at a time' )),
+    ]
 
     def do( self, argsin ):
-        parser = ArgumentParser( prog=self.name, description=self.blurb )
+        parser = self.buildParser()
+        args = parser.parse_args( argsin )
+        self.validate( parser, args )
 
-        parser.add_argument( 'input',
-                            help='Input file' )
-        parser.add_argument( 'output', nargs='?',
-                            help='Output file' )
-        parser.add_argument( '-f', '--force', action='store_true',
-                            help="Overwrite existing files" )
+        if args.batch:
+            return runBatch( [self.command( f, None ) for f in args.files],
+                            self.jobs )
+        self.checkOutputs( args )
+        return self.runFinal( self.build( args ) )
 
-        args = parser.parse_args( argsin )
+    def validate( self, parser, args ):
+        if not args.batch and len( args.files ) > 2:
+            parser.error( 'too many files; use -b to encode several' )
 
-        outpath = args.output
-        if outpath: 
-            outpath = Path( outpath )
-            checkExists( outpath, args.force )
+    def outputs( self, args ):
+        return [Path( f ) for f in args.files[1:]]
 
-        self.execute( args.input, outpath )
+    def build( self, args ):
+        outpath = None
+        if len( args.files ) > 1:
+            outpath = Path( args.files[1] )
+        # A WAV stream on stdin has no usable length in its header
+        return self.command( args.files[0], outpath,
+                            ignorelength=args.files[0] == '-' )
 
     @classmethod
-    def execute( self, input, output, quality=None ):
+    def execute( self, input, output, quality=None, wait=True,
+                ignorelength=False, **kwargs ):
         """Execute fdkaac to encode the file.
 
+        input -- The file to encode, or '-' for standard input
         quality -- A numeric quality, 1-5, to specify the encoding quality.
             (Specified with the `-m` option in fdkaac). If not specified,
             defaults to 5.
+        wait -- If false, start fdkaac and return without waiting for it
+        ignorelength -- Ignore the length in the WAV header. Needed when
+            reading from a pipe, where the length is not known in advance.
+        kwargs -- Passed on to `runCmd`
 
-        Return: Numeric exit code from fdkaac
+        Return: Numeric exit code from fdkaac, or the running process if
+            wait is false
         """
 
+        return runCmd( self.command( input, output, quality, ignorelength ),
+                      wait, **kwargs )
 
-        cmd = ['fdkaac']
+    @classmethod
+    def command( self, input, output, quality=None, ignorelength=False ):
+        """Build the fdkaac command to encode the file.
+
+        Arguments are as for `execute`.
+
+        Return: The command line, as a list
+        """
+
+        cmd = [_FDKAAC]
         if not quality: quality = 5
         cmd.extend( ('-m', str( quality )) )
+        if ignorelength:
+            cmd.append( '--ignorelength' )
 
         cmd.append( input )
 
         if output:
             cmd.extend( ('-o', output) )
 
-        # print( cmd )
-        # return 0
-        result = run( cmd )
-        return result.returncode
-vtAACEnc().register()
+        return cmd
+vtAACEnc.register()
 
 class vtRemux( vtCommand ):
     """Remux a video file and audio file into a new file""" 
-    def __init__( self ):
-        super().__init__( 'remux' )
 
-    def do( self, argsin ):
-        parser = ArgumentParser( prog=self.name, description=self.blurb )
+    name = 'remux'
 
-        parser.add_argument( 'video',
-                            help='Input video file. (Any audio tracks are ignored)' )
-        parser.add_argument( 'audio', 
-                            help='Input audio file. Should be appropriately encoded.' )
-        parser.add_argument( 'output', 
-                            help='Output video file' )
-        parser.add_argument( '-f', '--force', action='store_true',
-                            help="Overwrite existing files" )
+    arguments = [
+        ('video', dict( help='Input video file. ' +
+                        '(Any audio tracks are ignored)' )),
+        ('audio', dict( help='Input audio file. ' +
+                        'Should be appropriately encoded.' )),
+        ('output', dict( help='Output video file' )),
+    ]
 
-        args = parser.parse_args( argsin )
-
-        outpath = Path( args.output )
-        checkExists( outpath, args.force )
-        self.execute( args.video, args.audio, outpath )
+    def build( self, args ):
+        return self.command( args.video, args.audio, args.output, args.force )
 
     @classmethod
-    def execute( self, video, audio, output ):
+    def execute( self, video, audio, output, wait=True, force=False ):
         """Execute ffmpeg to encode the file.
 
-        Return: Numeric exit code from ffmpeg
+        wait -- If false, start ffmpeg and return without waiting for it
+        force -- Overwrite the output file if it exists
+
+        Return: Numeric exit code from ffmpeg, or the running process if
+            wait is false
+        """
+
+        return runCmd( self.command( video, audio, output, force ), wait )
+
+    @classmethod
+    def command( self, video, audio, output, force=False ):
+        """Build the ffmpeg command to remux the file.
+
+        force -- Overwrite the output file if it exists
+
+        Return: The command line, as a list
         """
 
         # Remux audio and video:
         # ffmpeg -i <input_video> -i <input_audio> -c copy -map 0:v:0 -map 1:a:0 <output_video>
-        cmd = ['ffmpeg', '-i', video, '-i', audio,
+        cmd = [_FFMPEG, overwriteFlag( force ), '-i', video, '-i', audio,
                '-c', 'copy', '-map', '0:v:0', '-map', '1:a:0', output]
-
-        # print( cmd )
-        # return 0
-        result = run( cmd )
-        return result.returncode
-vtRemux().register()
+        return cmd
+vtRemux.register()
 
 class vtAudiomix( vtCommand ):
     """Mix a video file with external audio tracks into a new file"""
-    def __init__( self ):
-        super().__init__( 'audiomix' )
+
+    name = 'audiomix'
+
+    arguments = [
+        ('video', dict( help='Input video file. ' +
+                        '(Any audio tracks are ignored)' )),
+        ('audio', dict( nargs='+', help='Input audio files, in WAV format' )),
+        ('output', dict( help='Output video file' )),
+        ('-n', '--normalize', dict( action='store_true',
+                                    help="Normalize audio to 0dB. " +
+                                    'Implies --staged' )),
+        ('-s', '--staged', dict( action='store_true',
+                                 help="Run mixdown, aacenc and remux as " +
+                                 'separate steps, instead of a single ' +
+                                 'ffmpeg' )),
+    ]
 
     def do( self, argsin ):
         """Remix the video file.
 
         This command combines the `mixdown`, `aacenc`, and `remux` commands
-        (and optionally 'normalize') into one. If any of the programs in the
-        pipeline returns a failure code, the script is aborted with an error.
-        Intermediate files are saved to a temporary directory, which is deleted
-        on exit.
+        (and optionally 'normalize') into one. By default, this is done with a
+        single ffmpeg process. With `--staged` or `--normalize`, each step is
+        run separately; if any of the programs in the pipeline returns a
+        failure code, the script is aborted with an error. Intermediate files
+        are saved to a temporary directory, which is deleted on exit.
         """
 
-        parser = ArgumentParser( prog=self.name, description=self.blurb )
-
-        parser.add_argument( 'video',
-                            help='Input video file. (Any audio tracks are ignored)' )
-        parser.add_argument( 'audio', nargs='+',
-                            help='Input audio files, in WAV format' )
-        parser.add_argument( 'output',
-                            help='Output video file' )
-        parser.add_argument( '-n', '--normalize', action='store_true',
-                            help="Normalize audio to 0dB" )
-        parser.add_argument( '-f', '--force', action='store_true',
-                            help="Overwrite existing files" )
-
+        parser = self.buildParser()
         args = parser.parse_args( argsin )
 
         outpath = Path( args.output )
-        checkExists( outpath, args.force )
 
-        with TemporaryDirectory() as tmppath:
-            tmp = Path( tmppath )
-            print( "Combining audio files..." )
-            result = vtMixdown.execute( args.audio, tmp / 'mix.wav' )
+        if not (args.staged or args.normalize):
+            print( "Mixing audio and remuxing video..." )
+            result = self.executeFused( args.video, args.audio, outpath,
+                                       args.force )
             if result:
                 print( f"Error running ffmpeg.", file=stderr )
                 exit( 1 )
+            return
+
+        # Check before doing any work, rather than finding out at the end
+        checkExists( outpath, args.force )
+
+        # Only needed here, so not imported for every command
+        from tempfile import TemporaryDirectory
+        with TemporaryDirectory() as tmppath:
+            tmp = Path( tmppath )
             if args.normalize:
-                print( "Normalizing audio..." )
-                result = vtNormalize.execute( tmp / 'mix.wav', tmp / 'norm.wav' )
+                print( "Combining audio files..." )
+                result = vtMixdown.execute( args.audio, tmp / 'mix.wav' )
                 if result:
-                    print( f"Error running sox.", file=stderr )
+                    print( f"Error running ffmpeg.", file=stderr )
                     exit( 1 )
-                (tmp / 'norm.wav').replace( tmp / 'mix.wav' )
-            print( "Encoding audio..." )
-            result = vtAACEnc.execute( tmp / 'mix.wav', tmp / 'mix.aac' )
-            if result:
-                print( f"Error running ffmpeg.", file=stderr )
+                # sox has to see the whole mix before it can normalize it,
+                # but its output can go straight to the encoder
+                print( "Normalizing and encoding audio..." )
+                source = vtNormalize.execute( tmp / 'mix.wav', '-',
+                                             wait=False, stdout=PIPE )
+                sourcename = 'sox'
+            else:
+                # Without normalization, the mix never needs to be on disk:
+                # pipe it straight into the encoder and run both at once
+                print( "Combining and encoding audio..." )
+                source = vtMixdown.execute( args.audio, '-', wait=False,
+                                           stdout=PIPE )
+                sourcename = 'ffmpeg'
+            enc = vtAACEnc.execute( '-', tmp / 'mix.aac', wait=False,
+                                   ignorelength=True, stdin=source.stdout )
+            # Only fdkaac should hold the read end, so the source gets
+            # SIGPIPE if fdkaac dies
+            source.stdout.close()
+            # Check the encoder first: if it fails, the source dies of
+            # SIGPIPE, which isn't the real error
+            encresult = enc.wait()
+            sourceresult = source.wait()
+            if encresult:
+                print( f"Error running fdkaac.", file=stderr )
+                exit( 1 )
+            if sourceresult:
+                print( f"Error running {sourcename}.", file=stderr )
                 exit( 1 )
             print( "Remuxing video..." )
-            result = vtRemux.execute( args.video, tmp / 'mix.aac', outpath )
+            result = vtRemux.execute( args.video, tmp / 'mix.aac', outpath,
+                                     force=args.force )
             if result:
                 print( f"Error running ffmpeg.", file=stderr )
                 exit( 1 )
 
             # run( '/bin/sh', cwd=tmp )
-vtAudiomix().register()
 
-class vtScale( vtCommand ):
-    """Scale a video down to a smaller size."""
+    @classmethod
+    def executeFused( self, video, audio, output, force=False ):
+        """Execute ffmpeg to mix, encode and remux in one pass.
 
-    def __init__( self ):
-        super().__init__( 'scale' )
+        force -- Overwrite the output file if it exists
 
-    def do( self, argsin ):
-        parser = ArgumentParser( prog=self.name, description=self.blurb )
+        libfdk_aac is used if ffmpeg has it; its `-vbr 5` is the same quality
+        as `aacenc`'s default. Otherwise, ffmpeg's own AAC encoder is used.
 
-        parser.add_argument( 'input',
-                            help='Input video file.' )
-        parser.add_argument( 'size',
-                            help='Size to rescale to, in WIDTH:HEIGHT format' )
-        parser.add_argument( 'output',
-                            help='Output video file' )
-        parser.add_argument( '-f', '--force', action='store_true',
-                            help="Overwrite existing files" )
+        Return: Numeric exit code from ffmpeg
+        """
 
-        args = parser.parse_args( argsin )
+        if self.hasEncoder( 'libfdk_aac' ):
+            audiocodec = ('-c:a', 'libfdk_aac', '-vbr', '5')
+        else:
+            audiocodec = ('-c:a', 'aac', '-b:a', '192k')
 
-        outpath = Path( args.output )
-        checkExists( outpath, args.force )
+        cmd = [_FFMPEG, overwriteFlag( force ), '-i', video]
+        for f in audio:
+            cmd.extend( ('-i', f) )
+        cmd.extend( ('-filter_complex',
+                     f'amix=inputs={len( audio )}:duration=first[a]',
+                     '-map', '0:v:0', '-map', '[a]',
+                     '-c:v', 'copy', *audiocodec, output) )
+        return runCmd( cmd )
 
-        cmd = ['ffmpeg', '-i', args.input,
-               '-vf', f"scale={args.size}", 
-               '-acodec', 'mp3', '-b:a', '64k', outpath]
-        run( cmd )
-vtScale().register()
+    @classmethod
+    def hasEncoder( self, encoder ):
+        """Check whether ffmpeg was built with the given encoder.
 
-class vtExtractAudio( vtCommand ):
-    """Extract an audio track from a file."""
+        Return: True if the encoder is available
+        """
 
-    def __init__( self ):
-        super().__init__( 'extaudio' )
+        result = run( [_FFMPEG, '-hide_banner', '-encoders'],
+                     capture_output=True, text=True )
+        return any( line.split()[1:2] == [encoder]
+                    for line in result.stdout.splitlines() )
+vtAudiomix.register()
 
-    def do( self, argsin ):
-        parser = ArgumentParser( prog=self.name, description=self.blurb )
-
-        parser.add_argument( 'input',
-                            help='Input video file.' )
-        parser.add_argument( 'output',
-                            help='Output audio file. Will be extracted from ' +
-                            'the original without any transcoding.' )
-        parser.add_argument( '-t', '--track', default=0, type=int,
-                            help="Number of audio track to extract, zero-based. " +
-                            '(Default 0)' )
-        parser.add_argument( '-f', '--force', action='store_true',
-                            help="Overwrite existing files" )
+class vtScale( vtCommand ):
+    """Scale a video down to a smaller size."""
 
-        args = parser.parse_args( argsin )
+    name = 'scale'
+    execOk = True
+
+    # Hardware acceleration methods. Each gives the ffmpeg options to decode
+    # onto the device, the scale filter that works there, and the encoder,
+    # so frames stay on the device from start to finish.
+    hwaccels = {
+        'nvenc': (['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda'],
+                  'scale_cuda', 'h264_nvenc'),
+        'vaapi': (['-init_hw_device', 'vaapi=va:/dev/dri/renderD128',
+                   '-hwaccel', 'vaapi', '-hwaccel_output_format', 'vaapi',
+                   '-hwaccel_device', 'va'],
+                  'scale_vaapi', 'h264_vaapi'),
+        'qsv': (['-hwaccel', 'qsv', '-hwaccel_output_format', 'qsv'],
+                'scale_qsv', 'h264_qsv'),
+    }
+
+    arguments = [
+        ('input', dict( help='Input video file.' )),
+        ('size', dict( help='Size to rescale to, in WIDTH:HEIGHT format' )),
+        ('output', dict( help='Output video file' )),
+        ('-a', '--hwaccel', dict( choices=list( hwaccels ),
+                                  help="Scale and encode on the GPU, " +
+                                  'using the given method' )),
+    ]
+
+    def build( self, args ):
+        overwrite = overwriteFlag( args.force )
+        if args.hwaccel:
+            hwopts, scaler, encoder = self.hwaccels[args.hwaccel]
+            cmd = [_FFMPEG, overwrite, *hwopts, '-i', args.input,
+                   '-vf', f"{scaler}={args.size}", '-c:v', encoder,
+                   '-acodec', 'mp3', '-b:a', '64k', args.output]
+        else:
+            cmd = [_FFMPEG, overwrite, '-i', args.input,
+                   '-vf', f"scale={args.size}", 
+                   '-acodec', 'mp3', '-b:a', '64k', args.output]
+        return cmd
+vtScale.register()
 
-        outpath = Path( args.output )
-        checkExists( outpath, args.force )
+class vtExtractAudio( vtCommand ):
+    """Extract an audio track from a file."""
 
-        cmd = ['ffmpeg', '-i', args.input, '-acodec', 'copy', '-map', 
-               f'0:a:{args.track}', outpath]
-        run( cmd )
-vtExtractAudio().register()
+    name = 'extaudio'
+    execOk = True
 
-class vtDecodeAudio( vtCommand ):
-    """Extract and decode audio tracks from a video"""
+    arguments = [
+        ('input', dict( help='Input video file.' )),
+        ('output', dict( help='Output audio file. Will be extracted from ' +
+                         'the original without any transcoding.' )),
+        ('-t', '--track', dict( default=0, type=int,
+                                help="Number of audio track to extract, " +
+                                'zero-based. (Default 0)' )),
+    ]
 
-    def __init__( self ):
-        super().__init__( 'decaudio' )
+    def build( self, args ):
+        return [_FFMPEG, overwriteFlag( args.force ), '-i', args.input,
+                '-acodec', 'copy', '-map', f'0:a:{args.track}', args.output]
+vtExtractAudio.register()
 
-    def do( self, argsin ):
-        parser = ArgumentParser( prog=self.name, description=self.blurb )
-
-        parser.add_argument( 'input',
-                            help='Input video file.' )
-        parser.add_argument( 'output',
-                            help='Output audio file. Will be transcoded into ' +
-                            'a format appropriate to the given filename.' )
-        parser.add_argument( '-t', '--track', action='append', type=int,
-                            help="Number of audio track(s) to extract, zero-based. " +
-                            'May be specified more than once. (Default 0)' )
-        parser.add_argument( '-n', '--number', action='store_true',
-                            help="Append track number to filename. Automatically " +
-                            'enabled if multuiple tracks specified.' )
-        parser.add_argument( '-f', '--force', action='store_true',
-                            help="Overwrite existing files" )
+class vtDecodeAudio( vtCommand ):
+    """Extract and decode audio tracks from a video"""
 
-        args = parser.parse_args( argsin )
+    name = 'decaudio'
+    execOk = True
+
+    arguments = [
+        ('input', dict( help='Input video file.' )),
+        ('output', dict( help='Output audio file. Will be transcoded into ' +
+                         'a format appropriate to the given filename.' )),
+        ('-t', '--track', dict( action='append', type=int,
+                                help="Number of audio track(s) to extract, " +
+                                'zero-based. May be specified more than ' +
+                                'once. (Default 0)' )),
+        ('-n', '--number', dict( action='store_true',
+                                 help="Append track number to filename. " +
+                                 'Automatically enabled if multuiple ' +
+                                 'tracks specified.' )),
+    ]
+
+    def build( self, args ):
         if not args.track:
             args.track = [0]
         if len( args.track ) > 1:
             args.number = True
 
+        # A single ffmpeg can write every track, reading the input only once
+        base = Path( args.output )
+        cmd = [_FFMPEG, overwriteFlag( args.force ), '-i', args.input]
         for t in args.track:
-            outpath = Path( args.output )
+            outpath = base
             if args.number:
-                outpath = outpath.parent / f"{outpath.stem}{t}{outpath.suffix}"
-            checkExists( outpath, args.force )
-            cmd = ['ffmpeg', '-i', args.input, '-map', 
-               f'0:a:{t}', outpath]
-            result = run( cmd )
-            if result.returncode:
-                return result.returncode
-        return 0
-vtDecodeAudio().register()
+                outpath = base.with_name( f"{base.stem}{t}{base.suffix}" )
+            cmd.extend( ('-map', f'0:a:{t}', outpath) )
+        return cmd
+vtDecodeAudio.register()
 
 class vtCompGate( vtCommand ):
     """Compress and noise gate an audio file"""
 
-    def __init__( self ):
-        super().__init__( 'compgate' )
+    name = 'compgate'
+
+    arguments = [
+        ('files', dict( nargs='*', metavar='FILE',
+                        help='Input and output audio files. With -b, ' +
+                        'any number of input files followed by an ' +
+                        'output directory.' )),
+        ('-b', '--batch', dict( action='store_true',
+                                help="Process each input file into the " +
+                                'output directory, several at a time' )),
+        ('-p', '--pipe', dict( action='store_true',
+                               help="Read WAV audio from standard input " +
+                               'and write it to standard output, ' +
+                               'instead of using files' )),
+        ('-a', '--attack', dict( type=float, default=0.1,
+                                 help='Attack time (default: %(default)g)' )),
+        ('-d', '--decay', dict( type=float, default=0.2,
+                                help='Decay time (default: %(default)g)' )),
+        ('-s', '--soft-knee', dict( type=float, default=6.0,
+                                    help='Soft knee in dB ' +
+                                    '(default: %(default)g)' )),
+        ('-g', '--gain', dict( type=float, default=-5.0,
+                               help='Gain in dB (default: %(default)g)' )),
+        ('-i', '--initial-volume', dict( type=float, default=-90.0,
+                                         help='Initial Volume in dB ' +
+                                         '(default: %(default)g)' )),
+        ('-l', '--delay', dict( type=float, default=0.2,
+                                help='Delay time (default: %(default)g)' )),
+        ('-G', '--gate', dict( type=float, default=-48.0,
+                               help='Gate threshold in dB ' +
+                               '(default: %(default)g)' )),
+        ('-C', '--compress', dict( type=float, default=-40.0,
+                                   help='Compression Threshold in dB ' +
+                                   '(default: %(default)g)' )),
+        ('-T', '--target', dict( type=float, default=-20.0,
+                                 help='Compression Target in dB ' +
+                                 '(default: %(default)g)' )),
+    ]
 
     def do( self, argsin ):
-        parser = ArgumentParser( prog=self.name, description=self.blurb )
-
-        parser.add_argument( 'input',
-                            help='Input audio file.' )
-        parser.add_argument( 'output',
-                            help='Output audio file.' )
-        parser.add_argument( '-a', '--attack', type=Decimal, default='.1',
-                            help='Attack time (default: %(default)s)' )
-        parser.add_argument( '-d', '--decay', type=Decimal, default='.2',
-                            help='Decay time (default: %(default)s)' )
-        parser.add_argument( '-s', '--soft-knee', type=Decimal, default='6',
-                            help='Soft knee in dB (default: %(default)s)' )
-        parser.add_argument( '-g', '--gain', type=Decimal, default='-5',
-                            help='Gain in dB (default: %(default)s)' )
-        parser.add_argument( '-i', '--initial-volume', type=Decimal, default='-90',
-                            help='Initial Volume in dB (default: %(default)s)' )
-        parser.add_argument( '-l', '--delay', type=Decimal, default='.2',
-                            help='Delay time (default: %(default)s)' )
-        parser.add_argument( '-G', '--gate', type=Decimal, default='-48',
-                            help='Gate threshold in dB (default: %(default)s)' )
-        parser.add_argument( '-C', '--compress', type=Decimal, default='-40',
-                            help='Compression Threshold in dB (default: %(default)s)' )
-        parser.add_argument( '-T', '--target', type=Decimal, default='-20',
-                            help='Compression Target in dB (default: %(default)s)' )
-
-        parser.add_argument( '-f', '--force', action='store_true',
-                            help="Overwrite existing files" )
-
+        parser = self.buildParser()
         args = parser.parse_args( argsin )
+        self.validate( parser, args )
+
+        if not args.batch:
+            self.checkOutputs( args )
+            return self.runFinal( self.build( args ) )
+
+        outdir = Path( args.files[-1] )
+        if not outdir.is_dir():
+            parser.error( f'{outdir} is not a directory' )
+        jobs = []
+        for f in args.files[:-1]:
+            outpath = outdir / Path( f ).name
+            # With -f, checkExists would delete the input before sox reads it
+            if outpath.resolve() == Path( f ).resolve():
+                parser.error( f'output for {f} would overwrite the input' )
+            jobs.append( (f, outpath) )
+        # Only touch existing files once every job is known to be valid
+        for f, outpath in jobs:
+            checkExists( outpath, args.force )
+        # Several progress displays on one terminal would be unreadable
+        return runBatch( [self.command( f, o, args, progress=False )
+                          for f, o in jobs], self.jobs )
+
+    def validate( self, parser, args ):
+        if args.pipe:
+            if args.batch:
+                parser.error( '-b and -p can\'t be combined' )
+            if args.files:
+                parser.error( 'no files can be given with -p' )
+        elif len( args.files ) < 2:
+            parser.error( 'an input and output file are required' )
+        elif not args.batch and len( args.files ) > 2:
+            parser.error( 'too many files; use -b to process several' )
+
+    def outputs( self, args ):
+        if args.pipe:
+            return []
+        return [Path( args.files[1] )]
+
+    def build( self, args ):
+        if args.pipe:
+            return self.command( '-', '-', args )
+        return self.command( args.files[0], Path( args.files[1] ), args )
 
-        outpath = Path( args.output )
-        checkExists( outpath, args.force )
+    @classmethod
+    def command( self, input, output, args, progress=True ):
+        """Build the sox command to compress and gate the file.
 
-        # print( args )
-        cmd = ['sox', '-S', args.input, args.output,
-               'compand',
-               f"{args.attack},{args.decay}",
-               f"{args.soft_knee}:-inf,{args.gate-Decimal( '.1' )}," +
-               f"-inf,{args.gate},{args.gate},"+
-               f"{args.compress},{args.target}",
-               str( args.gain ), str( args.initial_volume ), 
-               str( args.delay ) ]
-        # print( cmd )
-        result = run( cmd )
-        return result.returncode
-vtCompGate().register()
+        input, output -- The files to read and write. '-' reads or writes a
+            WAV stream on standard input or output, and turns off sox's
+            progress display.
+        args -- The parsed command options, giving the compander settings
+        progress -- Show sox's progress display
+
+        Return: The command line, as a list
+        """
+
+        cmd = [_SOX]
+        if progress and input != '-' and output != '-':
+            cmd.append( '-S' )
+        cmd.extend( soxFile( input ) )
+        cmd.extend( soxFile( output ) )
+        cmd.extend( ('compand',
+                     f"{args.attack:.15g},{args.decay:.15g}",
+                     f"{args.soft_knee:.15g}:-inf,{args.gate - 0.1:.15g}," +
+                     f"-inf,{args.gate:.15g},{args.gate:.15g},"+
+                     f"{args.compress:.15g},{args.target:.15g}",
+                     f"{args.gain:.15g}", f"{args.initial_volume:.15g}",
+                     f"{args.delay:.15g}") )
+        return cmd
+vtCompGate.register()
 
 class vtNormalize( vtCommand ):
     """Amplify an audio file as much as possible without clipping."""
 
-    def __init__( self ):
-        super().__init__( 'normalize' )
+    name = 'normalize'
 
-    def do( self, argsin ):
-        parser = ArgumentParser( prog=self.name, description=self.blurb )
+    arguments = [
+        ('input', dict( help='Input audio file.' )),
+        ('output', dict( help='Output audio file.' )),
+        ('-l', '--level', dict( type=float, default=0.0,
+                                help='dB level to normalize to' )),
+    ]
 
-        parser.add_argument( 'input',
-                            help='Input audio file.' )
-        parser.add_argument( 'output',
-                            help='Output audio file.' )
-        parser.add_argument( '-l', '--level', type=Decimal, default='0',
-                            help='dB level to normalize to' )
-        parser.add_argument( '-f', '--force', action='store_true',
-                            help="Overwrite existing files" )
+    def outputs( self, args ):
+        if args.output == '-':
+            return []
+        return [Path( args.output )]
 
-        args = parser.parse_args( argsin )
+    def build( self, args ):
+        return self.command( args.input, args.output, args.level )
 
-        outpath = Path( args.output )
-        checkExists( outpath, args.force )
+    @classmethod
+    def execute( self, input, output, level=0, wait=True, **kwargs ):
+        """Execute sox to normalize the audio.
+
+        wait -- If false, start sox and return without waiting for it
+        kwargs -- Passed on to `runCmd`
 
-        # print( args )
-        return self.execute( args.input, args.output, args.level )
+        Return: Numeric exit code from sox, or the running process if wait
+            is false
+        """
+        return runCmd( self.command( input, output, level ), wait, **kwargs )
 
     @classmethod
-    def execute( self, input, output, level=0 ):
-        """Execute sox to normalize the audio.
+    def command( self, input, output, level=0, progress=True ):
+        """Build the sox command to normalize the audio.
+
+        input, output -- The files to read and write. If '-', a WAV stream
+            is read from standard input or written to standard output, and
+            sox's progress display is turned off.
+        progress -- Show sox's progress display
 
-        Return: Numeric exit code from sox
+        Return: The command line, as a list
         """
-        cmd = ['sox', '-S', input, output, 'norm']
+        cmd = [_SOX]
+        if progress and input != '-' and output != '-':
+            cmd.append( '-S' )
+        cmd.extend( (*soxFile( input ), *soxFile( output ), 'norm') )
         if level != 0:
-            cmd.append( str( level ))
-        result = run( cmd )
-        return result.returncode
-vtNormalize().register()
+            cmd.append( f"{level:.15g}" )
+        return cmd
+vtNormalize.register()
+
+class vtPipeline( vtCommand ):
+    """Run several commands at once, each feeding the next"""
+
+    name = 'pipeline'
+    parents = []
+
+    arguments = [
+        ('stages', dict( help='JSON file listing the commands to run. ' +
+                         'This is a list of commands, each given as a ' +
+                         'list of arguments to vidtool.' )),
+    ]
+
+    def do( self, argsin ):
+        """Run a pipeline of commands.
+
+        Each command's standard output is connected to the next one's
+        standard input, and they all run at the same time, so audio passes
+        between them without any intermediate files. Commands read or write
+        the pipe when given '-' in place of a file (or `-p` for `compgate`).
+        Only commands which run a single program can be used.
+        """
+
+        import json
+
+        parser = self.buildParser()
+        args = parser.parse_args( argsin )
+
+        try:
+            with open( args.stages ) as f:
+                stages = json.load( f )
+        except (OSError, ValueError) as e:
+            parser.error( f"can't read {args.stages}: {e}" )
+        if not isinstance( stages, list ) or not stages:
+            parser.error( 'stages must be a non-empty list of commands' )
+
+        parsed = []
+        for stage in stages:
+            if not (isinstance( stage, list ) and stage and
+                    all( isinstance( arg, str ) for arg in stage )):
+                parser.error( 'each command must be a non-empty list of ' +
+                             f'strings: {json.dumps( stage )}' )
+            name, *stageargs = stage
+            if name not in vtCommand.commands:
+                parser.error( f'invalid command: {name}' )
+            command = vtCommand.commands[name]()
+            if command.build is None:
+                parser.error( f'{name} can\'t be used in a pipeline' )
+            stageparser = command.buildParser()
+            stageparsed = stageparser.parse_args( stageargs )
+            # Batches write files of their own, not to the pipe
+            if getattr( stageparsed, 'batch', False ):
+                parser.error( f'{name} -b can\'t be used in a pipeline' )
+            command.validate( stageparser, stageparsed )
+            parsed.append( (command, stageparsed) )
+
+        # Only delete files with -f once every stage is known to be valid,
+        # and no other stage's output is in the way
+        for command, stageparsed in parsed:
+            if not stageparsed.force:
+                command.checkOutputs( stageparsed )
+        for command, stageparsed in parsed:
+            if stageparsed.force:
+                command.checkOutputs( stageparsed )
+        cmds = [command.build( stageparsed )
+                for command, stageparsed in parsed]
+
+        procs = []
+        pipe = None
+        try:
+            for i, cmd in enumerate( cmds ):
+                last = i == len( cmds ) - 1
+                proc = runCmd( cmd, wait=False, stdin=pipe,
+                              stdout=None if last else PIPE )
+                # Only the next command should hold the read end, so each
+                # one sees EOF or SIGPIPE if its neighbour dies
+                if pipe:
+                    pipe.close()
+                pipe = proc.stdout
+                procs.append( proc )
+        except OSError as e:
+            # Don't leave the commands already started running on their own
+            if pipe:
+                pipe.close()
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+            print( f"Error running {stages[len( procs )][0]}: {e}",
+                  file=stderr )
+            return 1
+
+        results = [proc.wait() for proc in procs]
+        failed = [(stage, result) for stage, result in zip( stages, results )
+                  if result]
+        if not failed:
+            return 0
+
+        # A failed command makes the ones before it die of SIGPIPE, so the
+        # real failure is the last one that didn't
+        real = [f for f in failed if f[1] != -signal.SIGPIPE] or failed
+        stage, result = real[-1]
+        print( f"Error running {stage[0]}.", file=stderr )
+        # Killed by a signal: report it the way a shell would
+        if result < 0:
+            return 128 - result
+        return result
+vtPipeline.register()
 
 def checkExists( path, force=None ):
     """Check if a file already exists.
@@ -463,33 +884,152 @@ def checkExists( path, force=None ):
 
     Checks if the given path-like object exists.
 
-    If force is true, delete the file. If force is false, returns if the file
-    does *not* exist, and exits the script with an error and status 1 if the
-    file does exist.
+    If force is true, delete the file, if there is one. If force is false,
+    returns if the file does *not* exist, and exits the script with an error
+    and status 1 if the file does exist.
+
+    This is for programs that can't be told how to handle an existing file
+    themselves. ffmpeg commands use `overwriteFlag` instead.
     """
 
-    path = Path( path )
-    if path.exists():
-        if force:
-            path.unlink()
-        else:
-            print( f'{path} already exists. Use -f to overwrite', 
-                  file=stderr )
-            exit( 1 )
+    if not isinstance( path, Path ):
+        path = Path( path )
+    if force:
+        path.unlink( missing_ok=True )
+    elif path.exists():
+        print( f'{path} already exists. Use -f to overwrite', 
+              file=stderr )
+        exit( 1 )
+
+def soxFile( path ):
+    """Get the sox arguments to read or write a file.
+
+    path -- The file, or '-' for standard input or output
+
+    Return: A tuple of arguments. A pipe carries no file name for sox to
+        guess the format from, so it is given as WAV.
+    """
+
+    if path == '-':
+        return ('-t', 'wav', '-')
+    return (path,)
+
+def overwriteFlag( force ):
+    """Get the ffmpeg option for handling existing output files.
+
+    force -- Overwrite existing files
+
+    Return: `-y` to overwrite if force is true, otherwise `-n`, which makes
+        ffmpeg exit with an error instead
+    """
 
-parser = ArgumentParser( prog='vidtool', 
-                        description="A frontend for various video/audio fixes" )
+    return '-y' if force else '-n'
 
-parser.add_argument( 'command', 
-                    help='Command to perform. (Use `help` for a list)' )
-parser.add_argument( 'options', nargs='*',
-                    help='Options for the command' )
+def runCmd( cmd, wait=True, **kwargs ):
+    """Run an external command.
+
+    cmd -- The command line to run, as a list
+    wait -- If true, wait for the command to finish. Otherwise, start it
+        and return immediately.
+    kwargs -- Passed on to `Popen`, e.g. to redirect stdin or stdout
+
+    Return: Numeric exit code from the command, or the running process (a
+        `Popen` object) if wait is false
+    """
+
+    if not wait:
+        return Popen( cmd, **kwargs )
+    if kwargs or not hasattr( os, 'posix_spawnp' ):
+        return run( cmd, **kwargs ).returncode
+    return spawn( cmd )
+
+def spawn( cmd ):
+    """Run an external command with `posix_spawnp`, and wait for it.
+
+    cmd -- The command line to run, as a list
+
+    Unlike `subprocess`, this doesn't fork a copy of the Python process
+    first, which makes starting the command cheaper. The command inherits
+    stdin, stdout and stderr unchanged.
+
+    Return: Numeric exit code from the command
+    """
+
+    pid = os.posix_spawnp( cmd[0], [str( arg ) for arg in cmd], os.environ,
+                          setsigdef=_RESTORE_SIGNALS )
+    _, status = os.waitpid( pid, 0 )
+    return os.waitstatus_to_exitcode( status )
+
+def runBatch( cmds, jobs=None ):
+    """Run several independent external commands at once.
+
+    cmds -- A list of command lines to run
+    jobs -- The most commands to run at a time. Defaults to the number of
+        CPUs.
+
+    Stops at the first command that fails: Any commands not yet started are
+    skipped, though those already running are allowed to finish.
+
+    Return: Numeric exit code of the first failed command, or 0 if all of
+        them succeeded
+    """
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    pool = ThreadPoolExecutor( max_workers=jobs or os.cpu_count() )
+    with pool:
+        for future in as_completed( [pool.submit( runCmd, c ) for c in cmds] ):
+            result = future.result()
+            if result:
+                pool.shutdown( cancel_futures=True )
+                return result
+    return 0
+
+def positiveInt( value ):
+    """Parse a positive integer argument.
+
+    value -- The argument, as given on the command line
+
+    Return: The argument as an int. Raises `ArgumentTypeError` if it isn't a
+        positive integer.
+    """
 
-args = parser.parse_args( argv[1:2] )
-if args.command in vtCommand.commands:
-    vtCommand.commands[args.command].do( argv[2:] )
-else:
-    print( f"Invalid command: {args.command}", file=stderr )
-    exit( 1 )
+    try:
+        result = int( value )
+    except ValueError:
+        result = 0
+    if result < 1:
+        raise ArgumentTypeError( f"must be a positive integer: '{value}'" )
+    return result
+
+def main():
+    """Run the command given on the command line."""
+
+    parser = ArgumentParser( prog='vidtool', 
+                            description="A frontend for various " +
+                            'video/audio fixes' )
+
+    parser.add_argument( '-j', '--jobs', type=positiveInt,
+                        help='Number of files to process at a time, for ' +
+                        'commands that work on several. ' +
+                        '(Default: number of CPUs)' )
+    parser.add_argument( 'command', 
+                        help='Command to perform. (Use `help` for a list)' )
+    options = parser.add_argument( 'options', nargs=REMAINDER,
+                                  help='Options for the command' )
+    # argparse treats REMAINDER as required, but a command may have no
+    # options at all
+    options.required = False
+
+    args = parser.parse_args( argv[1:] )
+    vtCommand.jobs = args.jobs
+    if args.command in vtCommand.commands:
+        exit( vtCommand.commands[args.command]().do( args.options ) )
+    else:
+        print( f"Invalid command: {args.command}", file=stderr )
+        exit( 1 )
+
+if __name__ == '__main__':
+    main()
 
 # vtCommand.commands['mixdown'].do( argv[1:] )